@@ -0,0 +1,33 @@
+"""
+Gunicorn Configuration for Relatim Token Server
+===============================================
+
+Runs the token server in several Uvicorn worker processes so concurrent
+token requests (and their JWT signing) are spread across CPU cores.
+
+ENVIRONMENT VARIABLES:
+- PORT: Port to listen on (default 8080)
+- WEB_CONCURRENCY: Number of worker processes (default 2 x CPU cores + 1)
+
+RUNNING:
+gunicorn -c gunicorn_conf.py token_server:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Uvicorn workers pick up uvloop and httptools when installed
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# os.cpu_count() reports the host's cores inside a container, not the
+# instance's CPU quota, so deployments should set WEB_CONCURRENCY to fit
+# their memory. Each worker also keeps its own token cache, so repeat
+# requests only hit the cache when they land on the same worker.
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+
+# worker_connections is not set: gunicorn only applies it to eventlet and
+# gevent workers, and UvicornWorker does not read it
+
+# Keep idle client connections open longer than the platform proxies do
+keepalive = 75
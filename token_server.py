@@ -6,57 +6,267 @@ This is a reference implementation of the backend token server required for
 LiveKit voice AI integration. This server handles:
 
 1. Generating LiveKit access tokens for Android clients
-2. Dispatching AI agents to rooms
+2. Dispatching AI agents to rooms (queued to a Celery worker via Redis)
 
 REQUIREMENTS:
-- Python 3.8+
+- Python 3.9+
 - livekit-api package: pip install livekit-api
-- fastapi: pip install fastapi uvicorn
+- fastapi: pip install fastapi "uvicorn[standard]"
+- cachetools: pip install cachetools
+- orjson: pip install orjson
+- celery: pip install "celery[redis]"
+- redis: pip install redis
 
 ENVIRONMENT VARIABLES:
 - LIVEKIT_URL: Your LiveKit server URL (e.g., wss://your-project.livekit.cloud)
 - LIVEKIT_API_KEY: Your LiveKit API key
 - LIVEKIT_API_SECRET: Your LiveKit API secret
+- REDIS_URL: Redis used as the Celery broker and result backend
+- CORS_ORIGINS: Comma-separated browser origins to allow (CORS is off if unset)
+- UVICORN_RELOAD: Set to 1 to auto-reload on code changes (python token_server.py only)
 
 RUNNING:
-uvicorn token_server:app --host 0.0.0.0 --port 8080
+gunicorn -c gunicorn_conf.py token_server:app
+celery -A token_server.celery_app worker --loglevel=info
 """
 
 import os
+import time
+import asyncio
+import logging
 import uuid
 import datetime
-from typing import Optional
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+import aiohttp
+import orjson
+from cachetools import TTLCache
+from celery import Celery
+from celery.result import AsyncResult
+from celery.signals import worker_process_shutdown
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
+from redis import asyncio as redis_asyncio
 from livekit import api
 
+logger = logging.getLogger("relatim-token-server")
+
 # Configuration - using actual LiveKit credentials
 LIVEKIT_URL = os.getenv("LIVEKIT_URL", "wss://relatim-v1wlyfls.livekit.cloud")
 LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY", "APIgNUtuSTugMPF")
 LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET", "G94A3JBc7teQiXnmvA2RO1MTQWRf7FRa7XfWYJCebJAB")
 
+# Server API calls go over HTTP(S) rather than the WebSocket signalling URL
+LIVEKIT_HTTP_URL = LIVEKIT_URL.replace("wss://", "https://").replace("ws://", "http://")
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Token lifetime and the permissions granted to every participant; only the
+# room differs between tokens
+_TTL = datetime.timedelta(hours=1)
+_TTL_SECONDS = int(_TTL.total_seconds())
+_GRANT_FLAGS = dict(
+    room_join=True,
+    can_publish=True,
+    can_subscribe=True,
+    can_publish_data=True,
+)
+
+# Issued tokens are reused for repeat requests from the same participant.
+# Entries expire 5 minutes before the token TTL so clients never receive a
+# token that is about to expire.
+TOKEN_REFRESH_MARGIN = 300
+_token_cache = TTLCache(maxsize=10_000, ttl=_TTL_SECONDS - TOKEN_REFRESH_MARGIN)
+_token_cache_lock = threading.Lock()
+
+# Tokens currently being signed, so a burst of identical requests (e.g. an
+# app reconnecting after being foregrounded) signs the JWT only once
+_token_inflight: Dict[tuple, "asyncio.Task[dict]"] = {}
+
+# Repeat dispatches for the same room and agent (client retries) within 30
+# seconds return the already queued task instead of dispatching again. The
+# claim is kept in Redis so it holds across all server worker processes.
+DISPATCH_DEDUP_SECONDS = 30
+_redis = redis_asyncio.Redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_connect_timeout=5,
+    socket_timeout=5,
+)
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response encoded with orjson instead of the stdlib json module"""
+    
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+# Agent dispatches run on a Celery worker so the HTTP request does not wait
+# on LiveKit, and failed dispatches are retried
+# Task results and the queued-task markers behind them are kept for an hour
+DISPATCH_RESULT_SECONDS = 3600
+
+celery_app = Celery("relatim", broker=REDIS_URL, backend=REDIS_URL)
+celery_app.conf.update(
+    task_track_started=True,
+    result_expires=DISPATCH_RESULT_SECONDS,
+)
+
+# Celery task states reported by GET /dispatch-agent/{task_id}
+DISPATCH_STATUS = {
+    "PENDING": "queued",
+    "STARTED": "running",
+    "RETRY": "retrying",
+    "SUCCESS": "dispatched",
+    "FAILURE": "failed",
+}
+
+
+# Each worker process keeps one event loop and one pooled HTTP session, so
+# dispatches reuse open connections to LiveKit instead of reconnecting
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+_worker_session: Optional[aiohttp.ClientSession] = None
+_worker_livekit_api: Optional[api.LiveKitAPI] = None
+
+
+def _run_in_worker_loop(coro):
+    """Run a coroutine on this worker process's long-lived event loop"""
+    global _worker_loop
+    if _worker_loop is None:
+        _worker_loop = asyncio.new_event_loop()
+    return _worker_loop.run_until_complete(coro)
+
+
+def _get_livekit_api() -> api.LiveKitAPI:
+    """Return the worker's LiveKit API client, creating it on first use"""
+    global _worker_session, _worker_livekit_api
+    if _worker_livekit_api is None:
+        _worker_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=50),
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+        _worker_livekit_api = api.LiveKitAPI(
+            LIVEKIT_HTTP_URL,
+            LIVEKIT_API_KEY,
+            LIVEKIT_API_SECRET,
+            session=_worker_session
+        )
+    return _worker_livekit_api
+
+
+@worker_process_shutdown.connect
+def _close_worker_session(**kwargs):
+    """Close the pooled HTTP session when a worker process exits"""
+    if _worker_session is not None:
+        _worker_loop.run_until_complete(_worker_session.close())
+    if _worker_loop is not None:
+        _worker_loop.close()
+
+
+async def _create_agent_dispatch(room_name: str, agent_name: str) -> str:
+    """Create an agent dispatch through the LiveKit server API"""
+    # Created inside the loop so the HTTP session is bound to it
+    livekit_api = _get_livekit_api()
+    # This requires LiveKit Cloud with Agents enabled
+    dispatch = await livekit_api.agent_dispatch.create_dispatch(
+        api.CreateAgentDispatchRequest(
+            room=room_name,
+            agent_name=agent_name
+        )
+    )
+    return dispatch.id
+
+
+def _dispatch_error(e: Exception) -> RuntimeError:
+    """
+    Convert a dispatch failure into an error the web process can rebuild.
+    
+    LiveKit's TwirpError takes a keyword-only status and aiohttp errors carry
+    connection objects, so neither survives the Celery result backend.
+    """
+    if isinstance(e, api.TwirpError):
+        return RuntimeError(f"{e.code}: {e.message}")
+    return RuntimeError(str(e) or type(e).__name__)
+
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=10)
+def dispatch_agent_task(self, room_name: str, agent_name: str) -> dict:
+    """Dispatch an agent to a room, retrying transient failures"""
+    try:
+        dispatch_id = _run_in_worker_loop(_create_agent_dispatch(room_name, agent_name))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise self.retry(exc=_dispatch_error(e))
+    except api.TwirpError as e:
+        # 4xx errors (unknown room or agent, bad credentials) fail the same
+        # way on every attempt, so only server errors are retried
+        if e.status >= 500:
+            raise self.retry(exc=_dispatch_error(e))
+        raise _dispatch_error(e) from e
+    
+    return {
+        "room_name": room_name,
+        "agent_name": agent_name,
+        "dispatch_id": dispatch_id
+    }
+
+
 app = FastAPI(
     title="Relatim LiveKit Token Server",
     description="Token generation server for LiveKit voice AI integration",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# Enable CORS for mobile app
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # In production, restrict to your app's origin
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS is only needed for browser clients; the native Android app does not
+# send preflight requests, so the middleware is skipped unless origins are set
+CORS_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("CORS_ORIGINS", "").split(",")
+    if origin.strip()
+]
+if CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type", "authorization"],
+        max_age=86400,  # Let browsers cache the preflight for a day
+    )
+
+# Compress token responses for mobile clients; level 1 keeps CPU cost low
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=1)
 
 # Request/Response models
+class AgentSpec(BaseModel):
+    agentName: Optional[str] = None
+    agent_name: Optional[str] = None
+
+class RoomConfig(BaseModel):
+    agent_name: Optional[str] = None
+    agents: Optional[List[AgentSpec]] = None
+    
+    @property
+    def resolved_agent_name(self) -> Optional[str]:
+        """
+        Agent to dispatch - supports both formats:
+        Format 1: room_config.agent_name (simple)
+        Format 2: room_config.agents[0].agentName (from Android app)
+        """
+        if self.agent_name:
+            return self.agent_name
+        if self.agents:
+            return self.agents[0].agentName or self.agents[0].agent_name
+        return None
+
 class TokenRequest(BaseModel):
     room_name: str
     participant_identity: str
     participant_name: Optional[str] = None
-    room_config: Optional[dict] = None
+    room_config: Optional[RoomConfig] = None
 
 class TokenResponse(BaseModel):
     token: str
@@ -71,17 +281,85 @@ class HealthResponse(BaseModel):
     livekit_url: str
 
 
-@app.get("/health", response_model=HealthResponse)
+@app.get("/health", responses={200: {"model": HealthResponse}})
 async def health_check():
     """Health check endpoint"""
-    return HealthResponse(
-        status="healthy",
-        timestamp=datetime.datetime.utcnow().isoformat(),
-        livekit_url=LIVEKIT_URL
+    # Returned as a ready response so liveness probes skip model validation
+    return ORJSONResponse({
+        "status": "healthy",
+        "timestamp": datetime.datetime.fromtimestamp(
+            time.time(), tz=datetime.timezone.utc
+        ).isoformat(),
+        "livekit_url": LIVEKIT_URL
+    })
+
+
+def _build_jwt(request: TokenRequest, agent_name: Optional[str]) -> Tuple[str, int]:
+    """Build and sign the access token, returning the JWT and its expiry"""
+    # Create access token using new API
+    token = api.AccessToken(
+        LIVEKIT_API_KEY,
+        LIVEKIT_API_SECRET
+    ).with_identity(
+        request.participant_identity
+    ).with_name(
+        request.participant_name or request.participant_identity
+    ).with_grants(
+        api.VideoGrants(room=request.room_name, **_GRANT_FLAGS)
+    ).with_ttl(
+        _TTL
     )
+    
+    if agent_name:
+        # Set up room config to dispatch agent
+        token = token.with_room_config(
+            api.RoomConfiguration(
+                agents=[
+                    api.RoomAgentDispatch(
+                        agent_name=agent_name,
+                    )
+                ]
+            )
+        )
+    
+    # Generate the JWT
+    jwt_token = token.to_jwt()
+    
+    # Calculate expiration time
+    expires_at = int(time.time()) + _TTL_SECONDS
+    
+    return jwt_token, expires_at
+
+
+async def _sign_token(request: TokenRequest, agent_name: Optional[str], cache_key: tuple) -> dict:
+    """Sign a token and cache its response payload"""
+    # Sign the JWT off the event loop so concurrent requests are not blocked
+    jwt_token, expires_at = await asyncio.to_thread(_build_jwt, request, agent_name)
+    
+    # Built internally from trusted values, so returned without a second
+    # validation pass against TokenResponse
+    payload = {
+        "token": jwt_token,
+        "url": LIVEKIT_URL,
+        "room_name": request.room_name,
+        "participant_identity": request.participant_identity,
+        "expires_at": expires_at
+    }
+    with _token_cache_lock:
+        _token_cache[cache_key] = payload
+    return payload
+
 
+def _finish_token_inflight(cache_key: tuple, task: "asyncio.Task[dict]") -> None:
+    """Drop a finished signing task from the in-flight map"""
+    if _token_inflight.get(cache_key) is task:
+        del _token_inflight[cache_key]
+    # Mark any error retrieved in case every waiting client disconnected
+    if not task.cancelled():
+        task.exception()
 
-@app.post("/token", response_model=TokenResponse)
+
+@app.post("/token", responses={200: {"model": TokenResponse}})
 async def generate_token(request: TokenRequest):
     """
     Generate a LiveKit access token for the Android client.
@@ -96,111 +374,132 @@ async def generate_token(request: TokenRequest):
     dispatched to the room via agent dispatch.
     """
     try:
-        # Create access token using new API
-        token = api.AccessToken(
-            LIVEKIT_API_KEY,
-            LIVEKIT_API_SECRET
-        ).with_identity(
-            request.participant_identity
-        ).with_name(
-            request.participant_name or request.participant_identity
-        ).with_grants(
-            api.VideoGrants(
-                room_join=True,
-                room=request.room_name,
-                can_publish=True,
-                can_subscribe=True,
-                can_publish_data=True,
-            )
-        ).with_ttl(
-            datetime.timedelta(hours=1)
-        )
+        # Agent to dispatch automatically, if any
+        agent_name = request.room_config.resolved_agent_name if request.room_config else None
         
-        # Handle agent dispatch - support both formats:
-        # Format 1: room_config.agent_name (simple)
-        # Format 2: room_config.agents[0].agentName (from Android app)
-        agent_name = None
-        if request.room_config:
-            # Try format 1
-            if request.room_config.get("agent_name"):
-                agent_name = request.room_config["agent_name"]
-            # Try format 2 (Android app sends this)
-            elif request.room_config.get("agents"):
-                agents = request.room_config["agents"]
-                if agents and len(agents) > 0:
-                    agent_name = agents[0].get("agentName") or agents[0].get("agent_name")
+        # Reuse a previously issued token for the same participant and room
+        cache_key = (
+            request.participant_identity,
+            request.room_name,
+            agent_name,
+            request.participant_name,
+        )
+        with _token_cache_lock:
+            cached = _token_cache.get(cache_key)
+            if cached is not None:
+                if cached["expires_at"] - time.time() >= TOKEN_REFRESH_MARGIN:
+                    return ORJSONResponse(cached)
+                del _token_cache[cache_key]
         
-        if agent_name:
-            # Set up room config to dispatch agent
-            token = token.with_room_config(
-                api.RoomConfiguration(
-                    agents=[
-                        api.RoomAgentDispatch(
-                            agent_name=agent_name,
-                        )
-                    ]
-                )
+        # Join an identical request that is already signing this token, or
+        # start the signing task for everyone else to join
+        inflight = _token_inflight.get(cache_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(_sign_token(request, agent_name, cache_key))
+            _token_inflight[cache_key] = inflight
+            inflight.add_done_callback(
+                lambda task: _finish_token_inflight(cache_key, task)
             )
         
-        # Generate the JWT
-        jwt_token = token.to_jwt()
-        
-        # Calculate expiration time
-        expires_at = int(datetime.datetime.utcnow().timestamp()) + 3600
-        
-        return TokenResponse(
-            token=jwt_token,
-            url=LIVEKIT_URL,
-            room_name=request.room_name,
-            participant_identity=request.participant_identity,
-            expires_at=expires_at
-        )
+        # Shielded so a client disconnecting, including the one that started
+        # the signing, does not cancel it for the other requests
+        payload = await asyncio.shield(inflight)
+        return ORJSONResponse(payload)
         
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Failed to generate token")
         raise HTTPException(
             status_code=500,
             detail=f"Failed to generate token: {str(e)}"
         )
 
 
-@app.post("/dispatch-agent")
+def _queued_dispatch(task_id: str, room_name: str, agent_name: str) -> dict:
+    """Response body for a dispatch that has been queued"""
+    return {
+        "task_id": task_id,
+        "status": "queued",
+        "room_name": room_name,
+        "agent_name": agent_name
+    }
+
+
+@app.post("/dispatch-agent", status_code=202)
 async def dispatch_agent(room_name: str, agent_name: str = "relatim-voice-agent"):
     """
     Explicitly dispatch an agent to a room.
     
     This is an alternative to automatic agent dispatch.
     Use this if you need more control over when agents join.
+    
+    The dispatch is queued and performed by the Celery worker; poll
+    GET /dispatch-agent/{task_id} for its status.
     """
     try:
-        # Create Room Service client
-        room_service = api.RoomService(
-            LIVEKIT_URL.replace("wss://", "https://").replace("ws://", "http://"),
-            LIVEKIT_API_KEY,
-            LIVEKIT_API_SECRET
-        )
+        # JSON-encoded so names containing ":" cannot collide with each other
+        claim_key = "dispatch-agent:claim:" + orjson.dumps([room_name, agent_name]).decode()
+        task_id = str(uuid.uuid4())
         
-        # Create agent dispatch request
-        # This requires LiveKit Cloud with Agents enabled
-        dispatch_request = api.CreateAgentDispatchRequest(
-            room=room_name,
-            agent_name=agent_name
+        # SET NX lets exactly one request claim the dispatch; the others get
+        # the task id it stored. Loops only if the claim expires in between.
+        while not await _redis.set(claim_key, task_id, nx=True, ex=DISPATCH_DEDUP_SECONDS):
+            existing_task_id = await _redis.get(claim_key)
+            if existing_task_id is not None:
+                return _queued_dispatch(existing_task_id, room_name, agent_name)
+        
+        # Celery reports PENDING for ids it has never seen, so record that
+        # this one was queued for GET /dispatch-agent/{task_id}
+        task_key = f"dispatch-agent:task:{task_id}"
+        await _redis.set(task_key, 1, ex=DISPATCH_RESULT_SECONDS)
+        try:
+            # Publishing to the broker is a blocking Redis call
+            await asyncio.to_thread(
+                dispatch_agent_task.apply_async,
+                (room_name, agent_name),
+                task_id=task_id
+            )
+        except Exception:
+            # Release the claim so the client's next attempt can dispatch
+            await _redis.delete(claim_key, task_key)
+            raise
+        
+        return _queued_dispatch(task_id, room_name, agent_name)
+        
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to dispatch agent: {str(e)}"
         )
+
+
+@app.get("/dispatch-agent/{task_id}")
+async def dispatch_agent_status(task_id: str):
+    """Report the status of a queued agent dispatch"""
+    try:
+        result = AsyncResult(task_id, app=celery_app)
+        # Reading the state queries the Redis result backend
+        state = await asyncio.to_thread(lambda: result.state)
         
-        # Note: Agent dispatch API may vary based on LiveKit version
-        # Refer to LiveKit documentation for your specific setup
+        # Unknown ids (mistyped, or expired) also read as PENDING
+        if state == "PENDING" and not await _redis.exists(f"dispatch-agent:task:{task_id}"):
+            raise HTTPException(status_code=404, detail="Unknown dispatch task")
         
-        return {
-            "status": "dispatched",
-            "room_name": room_name,
-            "agent_name": agent_name
+        response = {
+            "task_id": task_id,
+            "status": DISPATCH_STATUS.get(state, state.lower())
         }
+        if state == "SUCCESS":
+            response.update(result.result)
+        elif state == "FAILURE":
+            response["error"] = str(result.result)
+        return response
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
-            detail=f"Failed to dispatch agent: {str(e)}"
+            detail=f"Failed to get dispatch status: {str(e)}"
         )
 
 
@@ -209,6 +508,9 @@ if __name__ == "__main__":
     import uvicorn
     
     port = int(os.getenv("PORT", "8081"))
+    # Auto-reload is for local development only: it runs a file watcher and
+    # limits the server to a single worker. Enable with UVICORN_RELOAD=1.
+    reload = os.getenv("UVICORN_RELOAD", "0") == "1"
     print("Starting Relatim LiveKit Token Server...")
     print(f"LiveKit URL: {LIVEKIT_URL}")
     print(f"API Key: {LIVEKIT_API_KEY[:8]}...")
@@ -218,5 +520,9 @@ if __name__ == "__main__":
         "token_server:app",
         host="0.0.0.0",
         port=port,
-        reload=True
+        loop="uvloop",
+        http="httptools",
+        reload=reload,
+        # Ignored by uvicorn when reload is enabled
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
     )
@@ -41,6 +41,9 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("relatim-voice-agent")
 
+# API keys required by the STT-LLM-TTS pipeline
+REQUIRED_ENV = ("DEEPGRAM_API_KEY", "GROQ_API_KEY", "CARTESIA_API_KEY")
+
 
 # System prompt for the Relatim assistant
 SYSTEM_PROMPT = """You are Relatim Voice Assistant, an AI helper for a field service management application.
@@ -68,10 +71,26 @@ Be helpful, efficient, and professional."""
 
 
 def prewarm(proc: agents.JobProcess):
-    """Prewarm the agent process with necessary models"""
+    """Prewarm the agent process with necessary models and clients"""
     # Load VAD (Voice Activity Detection) model
     proc.userdata["vad"] = silero.VAD.load()
-    logger.info("Agent prewarmed with VAD model")
+    
+    # Build the STT-LLM-TTS clients while the process is idle so it happens
+    # before a room is assigned. Each job process runs a single job, so these
+    # belong to that one room and are not long-lived.
+    proc.userdata["stt"] = deepgram.STT(
+        api_key=os.environ["DEEPGRAM_API_KEY"],
+        model="nova-2",
+        language="en",
+    )
+    proc.userdata["llm"] = groq.LLM(
+        model="llama-3.3-70b-versatile",
+        api_key=os.environ["GROQ_API_KEY"],
+    )
+    proc.userdata["tts"] = cartesia.TTS(
+        api_key=os.environ["CARTESIA_API_KEY"],
+    )
+    logger.info("Agent prewarmed with VAD model and STT/LLM/TTS clients")
 
 
 class RelatimAssistant(Agent):
@@ -85,26 +104,17 @@ class RelatimAssistant(Agent):
 
 async def entrypoint(ctx: JobContext):
     """Main entry point for the voice agent"""
-    logger.info(f"Agent starting for room: {ctx.room.name}")
+    logger.info("Agent starting for room: %s", ctx.room.name)
     
     # Wait for participant to connect
     await ctx.connect()
     
     # Create the agent session with STT-LLM-TTS pipeline
     session = AgentSession(
-        stt=deepgram.STT(
-            api_key=os.getenv("DEEPGRAM_API_KEY"),
-            model="nova-2",
-            language="en",
-        ),
-        llm=groq.LLM(
-            model="llama-3.3-70b-versatile",
-            api_key=os.getenv("GROQ_API_KEY"),
-        ),
-        tts=cartesia.TTS(
-            api_key=os.getenv("CARTESIA_API_KEY"),
-        ),
-        vad=silero.VAD.load(),
+        stt=ctx.proc.userdata["stt"],
+        llm=ctx.proc.userdata["llm"],
+        tts=ctx.proc.userdata["tts"],
+        vad=ctx.proc.userdata["vad"],
     )
     
     # Start the session
@@ -122,6 +132,11 @@ async def entrypoint(ctx: JobContext):
 
 
 if __name__ == "__main__":
+    # Check the API keys once here rather than failing in every prewarmed process
+    missing = [name for name in REQUIRED_ENV if not os.getenv(name)]
+    if missing:
+        raise SystemExit(f"Missing required environment variables: {', '.join(missing)}")
+    
     # Run the agent with WorkerOptions that supports agent_name
     cli.run_app(
         WorkerOptions(